@@ -1,23 +1,170 @@
 
+import os
+import re
+import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Dict, Optional, Iterator
+from functools import lru_cache
+from itertools import product
+from string import Formatter
+from typing import List, Dict, Optional, Iterator, Callable, Union, Set, Tuple
 import sqlite3
 import numpy as np
 import pandas as pd
 from scipy import stats
 
+# Columns the queries filter and join on, indexed before running queries in SQLite
+INDEXED_COLUMNS = {
+    "svc_tid": "serviceName, traceId",
+    "svc_start": "serviceName, startTime",
+    "parent_svc": "parentId, serviceName",
+}
+
 
 @dataclass
 class QueryTemplate:
-    """Represents a SQL query template for trace comparison."""
+    """
+    Represents a SQL query template for trace comparison.
+
+    If `handler` is set, it is used instead of running `query` against the database. It receives the whole table
+    as a DataFrame together with the query parameters, and must return the same `f`, `c` columns as `query`.
+    """
     name: str
     query: str
     relevant_incidents: List[str]
     description: Optional[str] = None
+    handler: Optional[Callable[[pd.DataFrame, Dict[str, str]], pd.DataFrame]] = None
+
+
+def _sqlite_divide(numerator: pd.Series, denominator: Union[pd.Series, int]) -> pd.Series:
+    """
+    Divide like SQLite does: truncating when both sides are integers, NULL when dividing by zero.
+    Integer columns with NULLs must be loaded with a nullable integer dtype (see `_load_table`), not as floats.
+    """
+    if np.isscalar(denominator):
+        denominator = pd.Series(denominator, index=numerator.index)
+    by_zero = (denominator == 0).fillna(False).astype(bool)
+    denominator = denominator.mask(by_zero, 1)
+    if pd.api.types.is_integer_dtype(numerator) and pd.api.types.is_integer_dtype(denominator):
+        quotient = numerator.abs() // denominator.abs() * np.sign(numerator) * np.sign(denominator)
+    else:
+        quotient = numerator / denominator
+    return quotient.mask(by_zero)
+
+
+def _sqlite_round(values: pd.Series, digits: int) -> pd.Series:
+    """Round half away from zero like SQLite's ROUND (NumPy rounds half to even)."""
+    scale = 10 ** digits
+    return np.sign(values) * np.floor(values.abs() * scale + 0.5) / scale
+
+
+def _count_by(features: pd.Series, weights: Optional[pd.Series] = None) -> pd.DataFrame:
+    """
+    The in-memory version of `SELECT <features> as f, COUNT(*) as c ... GROUP BY f`.
+
+    Each row is counted `weights` times (once if not given), which is how a self-join multiplies the rows.
+    Rows with a missing or zero weight are dropped, as they would have no partner in the join.
+    """
+    if weights is None:
+        weights = pd.Series(1, index=features.index)
+    matched = weights.fillna(0) > 0
+    counts = weights[matched].groupby(features[matched], dropna=False).sum()
+    return pd.DataFrame({"f": counts.index, "c": counts.values.astype(np.int64)})
+
+
+def _error_traces(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    entries = df[df["serviceName"] == params["entry_point"]]
+    errors_per_trace = df.loc[df["status"] == 1, "traceId"].value_counts()
+    return _count_by(_sqlite_divide(entries["startTime"], 3600), entries["traceId"].map(errors_per_trace))
+
+
+def _attribute_traces(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    entries_per_trace = df.loc[df["serviceName"] == params["entry_point"], "traceId"].value_counts()
+    return _count_by(df[params["attr_name"]], df["traceId"].map(entries_per_trace))
+
+
+def _system_architecture(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    parents = df[df["serviceName"] == params["service_name"]]
+    children_per_parent = df.loc[df["serviceName"] == params["service_name2"], "parentId"].value_counts()
+    return _count_by(_sqlite_divide(parents["startTime"], 3600), parents["spanId"].map(children_per_parent))
+
+
+def _bottlenecks(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    columns = ["traceId", "startTime", "endTime"]
+    # pandas pairs NULL keys with each other, SQL's `S1.traceId = S2.traceId` never matches them
+    spans = df.dropna(subset=["traceId"])
+    entries = spans.loc[spans["serviceName"] == params["entry_point"], columns]
+    services = spans.loc[spans["serviceName"] == params["service_name"], columns]
+    pairs = entries.merge(services, on="traceId", suffixes=("_1", "_2"))
+    ratio = _sqlite_divide(pairs["endTime_2"] - pairs["startTime_2"], pairs["endTime_1"] - pairs["startTime_1"])
+    return _count_by(_sqlite_round(ratio, 1))
+
+
+def _red_rate(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    spans = df[df["serviceName"] == params["service_name"]]
+    return _count_by(_sqlite_divide(spans["startTime"], 3600))
+
+
+def _red_error(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    spans = df[(df["serviceName"] == params["service_name"]) & (df["status"] == 1)]
+    return _count_by(spans["endTime"] - spans["startTime"])
+
+
+def _red_duration(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    spans = df[df["serviceName"] == params["service_name"]]
+    return _count_by(spans["endTime"] - spans["startTime"])
+
+
+def _attribute_frequency(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    return _count_by(df[params["attr_name"]])
+
+
+def _attribute_max_window(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    spans = df[df["serviceName"] == params["service_name"]]
+    maxima = spans[params["int_attr_name"]].groupby(_sqlite_divide(spans["startTime"], 3600), dropna=False).max()
+    return pd.DataFrame({"f": maxima.index, "c": maxima.values})
+
+
+def _filtered_attribute_frequency(df: pd.DataFrame, params: Dict[str, str]) -> pd.DataFrame:
+    spans = df[df["serviceName"] == params["service_name"]]
+    return _count_by(spans[params["attr_name"]])
+
+
+# A placeholder inside an SQL string literal, e.g. '{service_name}', stands for a value that can be bound
+_QUOTED_PARAM = re.compile(r"'\{(\w+)\}'")
+
+
+def _bind_quoted_params(query: str) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Replace the quoted placeholders of a query with sqlite3 `?` parameters.
+    Returns the new query and the names of the placeholders to bind, in order.
+    """
+    return _QUOTED_PARAM.sub("?", query), tuple(_QUOTED_PARAM.findall(query))
+
+
+@lru_cache(maxsize=128)
+def _prepare_query(query: str, table: str) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Fill in the table name of a query and bind its quoted placeholders, which is the same for all parameters.
+    The prepared query only needs formatting if it still has placeholders, e.g. for a column name.
+    """
+    return _bind_quoted_params(query.replace("{table_name}", table))
+
+
+@lru_cache(maxsize=64)
+def _query_param_names(query: str) -> Tuple[str, ...]:
+    """The names of the placeholders in a query."""
+    return tuple(t[1] for t in Formatter().parse(query) if t[1])
 
 
 class TraceComparator:
-    """Compares trace data between two SQL tables using configurable queries."""
+    """
+    Compares trace data between two SQL tables using configurable queries.
+
+    Tables are loaded into memory the first time a handler needs them and are reused by later comparisons. If a table
+    changes after that, call `clear_cache` so that the next comparison reads it again.
+    """
 
     def __init__(self, connection: sqlite3.Connection):
         """
@@ -27,6 +174,8 @@ class TraceComparator:
             connection: SQLite database connection
         """
         self.connection = connection
+        self._table_cache: Dict[str, pd.DataFrame] = {}
+        self._indexed_tables: Set[str] = set()
         self.default_queries = [
             QueryTemplate(
                 name="error_traces",
@@ -39,7 +188,8 @@ class TraceComparator:
                 GROUP BY S1.startTime / 3600;
                 """,
                 relevant_incidents=["crush", "packet_loss"],
-                description="Find traces of a service that having an error"
+                description="Find traces of a service that having an error",
+                handler=_error_traces
             ),
             QueryTemplate(
                 name="attribute_traces",
@@ -51,7 +201,8 @@ class TraceComparator:
                 GROUP BY S2.{attr_name};
                 """,
                 relevant_incidents=["crush", "packet_loss"],
-                description="Find traces that have a particular attribute"
+                description="Find traces that have a particular attribute",
+                handler=_attribute_traces
             ),
             QueryTemplate(
                 name="system_architecture",
@@ -64,7 +215,8 @@ class TraceComparator:
                 GROUP BY S1.startTime / 3600;
                 """,
                 relevant_incidents=["crush", "packet_loss"],
-                description="Discover architecture of the whole system"
+                description="Discover architecture of the whole system",
+                handler=_system_architecture
             ),
             QueryTemplate(
                 name="bottlenecks",
@@ -77,7 +229,8 @@ class TraceComparator:
                 GROUP BY f;
                 """,
                 relevant_incidents=["cpu_load", "disk_io_stress", "latency", "memory_stress"],
-                description="Find bottlenecks"
+                description="Find bottlenecks",
+                handler=_bottlenecks
             ),
             QueryTemplate(
                 name="red_rate",
@@ -88,7 +241,8 @@ class TraceComparator:
                 GROUP BY startTime / 3600;
                 """,
                 relevant_incidents=["crush", "packet_loss", "cpu_load", "disk_io_stress", "latency", "memory_stress"],
-                description="RED metrics - rate"
+                description="RED metrics - rate",
+                handler=_red_rate
             ),
             QueryTemplate(
                 name="red_error",
@@ -100,7 +254,8 @@ class TraceComparator:
                 GROUP BY endTime - startTime;
                 """,
                 relevant_incidents=["crush", "packet_loss", "cpu_load", "disk_io_stress", "latency", "memory_stress"],
-                description="RED metrics - error"
+                description="RED metrics - error",
+                handler=_red_error
             ),
             QueryTemplate(
                 name="red_duration",
@@ -111,7 +266,8 @@ class TraceComparator:
                 GROUP BY endTime - startTime;
                 """,
                 relevant_incidents=["crush", "packet_loss", "cpu_load", "disk_io_stress", "latency", "memory_stress"],
-                description="RED metrics - duration"
+                description="RED metrics - duration",
+                handler=_red_duration
             ),
             QueryTemplate(
                 name="attribute_frequency",
@@ -121,7 +277,8 @@ class TraceComparator:
                 GROUP BY {attr_name};
                 """,
                 relevant_incidents=["crush", "packet_loss", "cpu_load", "disk_io_stress", "latency", "memory_stress"],
-                description="Frequency of an attribute"
+                description="Frequency of an attribute",
+                handler=_attribute_frequency
             ),
             QueryTemplate(
                 name="attribute_max_window",
@@ -132,7 +289,8 @@ class TraceComparator:
                 GROUP BY startTime / 3600;
                 """,
                 relevant_incidents=["crush", "packet_loss"],
-                description="Max value of an attribute for every 5 minute window"
+                description="Max value of an attribute for every 5 minute window",
+                handler=_attribute_max_window
             ),
             QueryTemplate(
                 name="filtered_attribute_frequency",
@@ -143,7 +301,8 @@ class TraceComparator:
                 GROUP BY {attr_name};
                 """,
                 relevant_incidents=["crush", "packet_loss"],
-                description="Frequency of an attribute after filtering by another attribute"
+                description="Frequency of an attribute after filtering by another attribute",
+                handler=_filtered_attribute_frequency
             )
         ]
 
@@ -165,60 +324,169 @@ class TraceComparator:
 
         Returns:
             Dictionary mapping query names to their Wasserstein distances
+
+        Note:
+            If any query is run as SQL (i.e. has no handler), this adds the indexes in INDEXED_COLUMNS to both tables.
+            They are written to the database file and stay there after the comparison.
         """
         queries = queries or self.default_queries
-        results = {}
+        if any(query_template.handler for query_template in queries):
+            self._load_table(table1)
+            self._load_table(table2)
+        if any(query_template.handler is None for query_template in queries):
+            self._create_indexes(table1)
+            self._create_indexes(table2)
 
-        for query_template in queries:
-            distances = []
-            for params in self._iterate_parameters(query_template.query, parameters):
-                syn_data = self._execute_query(query_template.query, table1, params)
-                real_data = self._execute_query(query_template.query, table2, params)
+        # Handlers may run in parallel: they release the GIL in numpy and only read the cached tables. pandas doesn't
+        # promise that concurrent reads of one DataFrame are thread-safe, so handlers must never modify their input.
+        distances = defaultdict(list)
+        handler_futures = []
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for query_template in queries:
+                if query_template.handler is None:
+                    # sqlite3 connections may only be used by the thread that created them, so these run here
+                    distances[query_template.name].extend(
+                        self._compare_sql_query(query_template.query, table1, table2, parameters))
+                    continue
+                for params in self._iterate_parameters(query_template.query, parameters):
+                    future = executor.submit(self._compare_query, query_template.handler, table1, table2, params)
+                    handler_futures.append((query_template.name, future))
 
-                if len(syn_data) > 0 and len(real_data) > 0:
-                    distance = self._calculate_wasserstein(syn_data, real_data)
-                    if distance is not None:
-                        distances.append(distance)
+            # Collected in submission order, so that the averages don't depend on scheduling
+            for name, future in handler_futures:
+                distance = future.result()
+                if distance is not None:
+                    distances[name].append(distance)
 
-            if distances:
-                results[query_template.name] = np.mean(distances)
+        return {
+            query_template.name: np.mean(distances[query_template.name])
+            for query_template in queries if distances[query_template.name]
+        }
 
-        return results
+    def _compare_sql_query(
+            self,
+            query: str,
+            table1: str,
+            table2: str,
+            parameters: Dict[str, List[str]]
+    ) -> List[float]:
+        """Run an SQL query on both tables for every parameter combination and compare the results."""
+        syn_query = _prepare_query(query, table1)
+        real_query = _prepare_query(query, table2)
+        distances = []
+        for params in self._iterate_parameters(query, parameters):
+            distance = self._compare_results(self._execute_query(syn_query, params), self._execute_query(real_query, params))
+            if distance is not None:
+                distances.append(distance)
+        return distances
 
-    def _execute_query(self, query: str, table: str, params: Dict[str, str]) -> pd.DataFrame:
-        """Execute a query and return results as a DataFrame."""
-        formatted_query = query.format(table_name=table, **params)
-        return pd.read_sql_query(formatted_query, self.connection)
+    def clear_cache(self) -> None:
+        """Forget the loaded and indexed tables, e.g. after they were modified in the database."""
+        self._table_cache.clear()
+        self._indexed_tables.clear()
+
+    def _compare_query(
+            self,
+            handler: Callable[[pd.DataFrame, Dict[str, str]], pd.DataFrame],
+            table1: str,
+            table2: str,
+            params: Dict[str, str]
+    ) -> Optional[float]:
+        """Run an in-memory query on both tables and compare the results."""
+        syn_data = handler(self._load_table(table1), params)
+        real_data = handler(self._load_table(table2), params)
+        return self._compare_results(syn_data, real_data)
+
+    def _compare_results(self, syn_data: pd.DataFrame, real_data: pd.DataFrame) -> Optional[float]:
+        """Calculate the distance between two query results, or None if either of them is empty."""
+        if len(syn_data) > 0 and len(real_data) > 0:
+            return self._calculate_wasserstein(syn_data, real_data)
+        return None
+
+    def _load_table(self, table: str) -> pd.DataFrame:
+        """Load a whole table as a DataFrame. Tables are read once and cached until `clear_cache` is called."""
+        if table not in self._table_cache:
+            df = pd.read_sql_query(f"SELECT * FROM {table}", self.connection)
+            # pandas loads integer columns that have NULLs as floats. SQLite types each value, so ask it which of
+            # those columns hold only integers, and keep them as integers (e.g. for SQLite's integer division).
+            float_columns = list(df.select_dtypes("float").columns)
+            if float_columns:
+                real_counts = self.connection.execute(
+                    "SELECT " + ", ".join(f"""COUNT(CASE WHEN typeof("{column}") = 'real' THEN 1 END)"""
+                                          for column in float_columns) + f" FROM {table}"
+                ).fetchone()
+                for column, real_count in zip(float_columns, real_counts):
+                    if real_count == 0:
+                        df[column] = df[column].astype("Int64")
+            self._table_cache[table] = df
+        return self._table_cache[table]
+
+    def _create_indexes(self, table: str) -> None:
+        """
+        Create the indexes in INDEXED_COLUMNS on a table, once. The indexes are stored in the database file.
+        Indexes that can't be created are skipped with a warning, and so are all of them if the database is read-only.
+        """
+        if table in self._indexed_tables:
+            return
+        self._indexed_tables.add(table)
+        for name, columns in INDEXED_COLUMNS.items():
+            try:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{name} ON {table}({columns})")
+            except sqlite3.OperationalError as e:
+                if "readonly" in str(e):
+                    warnings.warn(f"The database is read-only, so table {table} is not indexed and queries will scan it")
+                    return
+                warnings.warn(f"Could not create index on {table}({columns}): {e}")
+
+    def _execute_query(self, prepared_query: Tuple[str, Tuple[str, ...]], params: Dict[str, str]) -> pd.DataFrame:
+        """Execute a query prepared by _prepare_query and return results as a DataFrame."""
+        query, bound_params = prepared_query
+        if "{" in query or "}" in query:
+            query = query.format(**params)
+        cursor = self.connection.execute(query, [params[name] for name in bound_params])
+        return pd.DataFrame.from_records(cursor.fetchall(), columns=[column[0] for column in cursor.description])
 
     @staticmethod
     def _calculate_wasserstein(syn: pd.DataFrame, real: pd.DataFrame) -> Optional[float]:
-        """Calculate Wasserstein distance between two distributions."""
-        syn["c"] = syn["c"] / syn["c"].sum()
-        real["c"] = real["c"] / real["c"].sum()
+        """
+        Calculate the Wasserstein distance between the distributions of `f` in two results, with `c` as the weights.
+        Rows with a NULL `f` are dropped. Features that aren't numbers are unordered labels, so they are compared with
+        the discrete metric (i.e. the total variation distance), which doesn't depend on the labels themselves.
+
+        Returns None, excluding the result from the comparison, if either side has no positive weight. Weights must
+        not be negative: a result with a negative `c` (e.g. attribute_max_window over a negative attribute) is
+        excluded as well, with a warning.
+        """
+        features, weights = [], []
+        for data in (syn, real):
+            data = data[data["f"].notna()]
+            features.append(data["f"].infer_objects())
+            weights.append(data["c"].fillna(0).to_numpy(dtype=float))
+        syn_weights, real_weights = weights
+
+        if (syn_weights < 0).any() or (real_weights < 0).any():
+            warnings.warn("Query result has negative weights in `c` and is excluded from the comparison")
+            return None
+        if not (syn_weights.sum() > 0 and real_weights.sum() > 0):
+            return None
 
-        all_features = set(syn["f"].values) | set(real["f"].values)
-        syn = syn.set_index("f").reindex(all_features).fillna(0)
-        real = real.set_index("f").reindex(all_features).fillna(0)
+        if all(pd.api.types.is_numeric_dtype(f) for f in features):
+            # Nullable integers (see `_load_table`) become plain floats
+            syn_features, real_features = (f.to_numpy(dtype=float) for f in features)
+            return stats.wasserstein_distance(syn_features, real_features, u_weights=syn_weights, v_weights=real_weights)
 
-        return stats.wasserstein_distance(syn["c"], real["c"])
+        labels = pd.Index(pd.concat(features, ignore_index=True).unique())
+        syn_p, real_p = (
+            np.bincount(labels.get_indexer(f), weights=w, minlength=len(labels)) / w.sum()
+            for f, w in zip(features, weights)
+        )
+        return 0.5 * np.abs(syn_p - real_p).sum()
 
     @staticmethod
     def _iterate_parameters(query: str, parameters: Dict[str, List[str]]) -> Iterator[Dict[str, str]]:
         """Generate all possible parameter combinations for a query."""
-        from string import Formatter
-
-        def _inner(partial: Dict[str, str], params_left: List[str]) -> Iterator[Dict[str, str]]:
-            if not params_left:
-                yield partial
-                return
-
-            name = params_left[0]
-            for value in parameters[name]:
-                new_partial = partial.copy()
-                new_partial[name] = value
-                yield from _inner(new_partial, params_left[1:])
-
-        query_params = {t[1] for t in Formatter().parse(query) if t[1] is not None}
+        query_params = _query_param_names(query)
         relevant_params = [p for p in parameters if p in query_params]
 
-        return _inner({}, relevant_params)
\ No newline at end of file
+        for values in product(*(parameters[name] for name in relevant_params)):
+            yield dict(zip(relevant_params, values))
@@ -1,95 +1,170 @@
-import json
+import asyncio
 import os
+from bisect import bisect_left
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional, List
 
-import requests
+import httpx
+import orjson
 
 JAEGER_URL = "http://localhost:16686"
 APP = "hotelReservation"
+MAX_CONNECTIONS = 32
 
 
-def download_traces_from_jaeger(service_name: str, jaeger_url: str, target_dir: Path) -> int:
-    response = requests.get(f"{jaeger_url}/api/traces?service={service_name}&limit=10000").json()
-    traces = []
-    for trace in response["data"]:
-        trace_id = trace["traceID"]
-        response = requests.get(f"{jaeger_url}/api/traces/{trace_id}").json()
-        traces.extend(response["data"])
+def _jaeger_client() -> httpx.AsyncClient:
+    # No timeout, like the requests calls this replaced: searching 10,000 traces can take a while
+    return httpx.AsyncClient(limits=httpx.Limits(max_connections=MAX_CONNECTIONS), timeout=None)
+
+
+async def _download_traces(client: httpx.AsyncClient, service_name: str, jaeger_url: str, target_dir: Path) -> int:
+    response = (await client.get(f"{jaeger_url}/api/traces?service={service_name}&limit=10000")).json()
+
+    async def download_trace(trace_id: str) -> List[dict]:
+        return (await client.get(f"{jaeger_url}/api/traces/{trace_id}")).json()["data"]
+
+    # The client's connection pool bounds how many of these run at once
+    responses = await asyncio.gather(*[download_trace(trace["traceID"]) for trace in response["data"]])
+    traces = [trace for data in responses for trace in data]
     os.makedirs(target_dir, exist_ok=True)
     target_file = target_dir / f"{service_name}.json"
-    with open(target_file, "w") as f:
-        json.dump(traces, f, indent=4)
+    with open(target_file, "wb") as f:
+        f.write(orjson.dumps(traces, option=orjson.OPT_INDENT_2))
     # print(f"Downloaded {len(traces)} traces for {service_name} to {target_file}.")
     return len(traces)
 
 
-def download_traces_from_jaeger_for_all_services(target_dir: Path, jaeger_url: str = JAEGER_URL) -> int:
-    response = requests.get(f"{jaeger_url}/api/services")
-    total = 0
-    all_services = response.json()["data"] or []
-    for service in all_services:
-        if "jaeger" in service:
-            # print("Skipping jaeger service", service)
-            continue
-        total += download_traces_from_jaeger(service, jaeger_url, target_dir)
+async def _download_traces_for_all_services(target_dir: Path, jaeger_url: str) -> int:
+    async with _jaeger_client() as client:
+        response = await client.get(f"{jaeger_url}/api/services")
+        total = 0
+        all_services = response.json()["data"] or []
+        for service in all_services:
+            if "jaeger" in service:
+                # print("Skipping jaeger service", service)
+                continue
+            total += await _download_traces(client, service, jaeger_url, target_dir)
     return total
 
 
+def download_traces_from_jaeger(service_name: str, jaeger_url: str, target_dir: Path) -> int:
+    async def download() -> int:
+        async with _jaeger_client() as client:
+            return await _download_traces(client, service_name, jaeger_url, target_dir)
+    return asyncio.run(download())
+
+
+def download_traces_from_jaeger_for_all_services(target_dir: Path, jaeger_url: str = JAEGER_URL) -> int:
+    return asyncio.run(_download_traces_for_all_services(target_dir, jaeger_url))
+
+
+@lru_cache(maxsize=4096)
+def _url_to_service_name(url: str) -> str:
+    """The service named by an http.url tag: the URL without its scheme and query string."""
+    hostname = url.split('?')[0]
+    if hostname.startswith("http://"):
+        hostname = hostname[len("http://"):]
+    return hostname
+
+
 def _handle_jaeger_trace(jaeger_trace: dict) -> dict:
     from gent.ml.app_denormalizer import Component, prepare_tx_structure
 
-    def get_service_name(s):
+    # Spans of the same process share these, so they are built once per process rather than per span
+    processes = jaeger_trace["processes"]
+    process_to_service_name = {process_id: process["serviceName"] for process_id, process in processes.items()}
+    process_to_metadata = {
+        process_id: {f"process_{t['key']}": t["value"] for t in process["tags"]}
+        for process_id, process in processes.items()
+    }
+
+    def scan_tags(s):
+        """The span's service name, whether it has an error, and its tags as a dict, in a single pass over its tags."""
+        service_name = None
+        has_error = False
+        metadata = {}
         for tag in s["tags"]:
-            if tag["key"] == "http.url":
-                hostname = tag["value"].split('?')[0]
-                if hostname.startswith("http://"):
-                    hostname = hostname[len("http://"):]
-                return hostname
-        return jaeger_trace["processes"][s["processID"]]["serviceName"]
-    span_to_service_name = {s["spanID"]: (get_service_name(s), s["startTime"]) for s in jaeger_trace["spans"]}
+            key, value = tag["key"], tag["value"]
+            if key == "http.url" and service_name is None:
+                service_name = _url_to_service_name(value)
+            elif (key == "error" and value is True) or (key == "http.status_code" and value > 300):
+                has_error = True
+            metadata[key] = value
+        if service_name is None:
+            service_name = process_to_service_name[s["processID"]]
+        return service_name, has_error, metadata
+
+    # Gather the per-span fields once, as columns, instead of going back to the span dicts for each use
+    spans = jaeger_trace["spans"]
+    span_ids = [s["spanID"] for s in spans]
+    start_times = [s["startTime"] for s in spans]
+    tag_scans = [scan_tags(s) for s in spans]
+    service_names = [service_name for service_name, _, _ in tag_scans]
+
+    # A span ID that appears twice is counted once, with the last span's service and start time
+    span_to_service_name = dict(zip(span_ids, zip(service_names, start_times)))
+    service_to_start_times = defaultdict(list)
+    for service_name, start_time in span_to_service_name.values():
+        service_to_start_times[service_name].append(start_time)
+    for service_start_times in service_to_start_times.values():
+        service_start_times.sort()
     span_id_to_ts_name = {}
     components = []
-    for span in jaeger_trace["spans"]:
-        service_name, start_time = span_to_service_name[span["spanID"]]
-        dup_names = [t for s, t in span_to_service_name.values() if s == service_name]
-        dup_names = sorted(dup_names)
-        name = f'{service_name}*{dup_names.index(start_time)}'
-        span_id_to_ts_name[span["spanID"]] = name
-    for span in jaeger_trace["spans"]:
+    for span_id, (service_name, start_time) in span_to_service_name.items():
+        # bisect_left finds the first of equal start times, so those spans share an index
+        index = bisect_left(service_to_start_times[service_name], start_time)
+        span_id_to_ts_name[span_id] = f'{service_name}*{index}'
+    for span, span_id, start_time, (_, has_error, metadata) in zip(spans, span_ids, start_times, tag_scans):
         components.append(Component(
-            component_id=span_id_to_ts_name[span["spanID"]],
-            start_time=span["startTime"],
-            end_time=span["startTime"] + span["duration"],
-            has_error=any(
-                ((tag["key"] == "error" and tag["value"] is True)
-                or tag["key"] == "http.status_code" and tag["value"] > 300)
-                for tag in span["tags"]),
+            component_id=span_id_to_ts_name[span_id],
+            start_time=start_time,
+            end_time=start_time + span["duration"],
+            has_error=has_error,
             children_ids=[span_id_to_ts_name.get(ref["spanID"]) for ref in span["references"] if ref["refType"] == "CHILD_OF"],
             group="",
-            metadata={t["key"]: t["value"] for t in span["tags"]} | {f"process_{t['key']}": t["value"] for t in jaeger_trace['processes'][span["processID"]]['tags']},
+            metadata=metadata | process_to_metadata[span["processID"]],
             component_type="jaeger",
             duration=span["duration"]
         ))
     return prepare_tx_structure(transaction_id=jaeger_trace["traceID"], components=components)
 
 
+def list_trace_files(directory: str) -> List[str]:
+    """Paths of the trace (.json) files in a directory."""
+    with os.scandir(directory) as entries:
+        return [entry.path for entry in entries if entry.name.endswith(".json") and entry.is_file()]
+
+
 def translate_jaeger_to_gent(from_dir: str, to_dir: Optional[str] = None) -> None:
     if not to_dir:
         to_dir = from_dir.replace("raw_jaeger", "gent")
     os.makedirs(to_dir, exist_ok=True)
-    for service_file in os.listdir(from_dir):
-        with open(os.path.join(from_dir, service_file)) as f:
-            jaeger_traces = json.load(f)
-        translate_jaeger_to_gent_from_list(jaeger_traces, os.path.join(to_dir, service_file))
+    service_files = list_trace_files(from_dir)
+    # Every file is translated independently, and the translation is CPU bound
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(
+            _translate_jaeger_file,
+            service_files,
+            [os.path.join(to_dir, os.path.basename(service_file)) for service_file in service_files],
+        ))
+
+
+def _translate_jaeger_file(from_path: str, to_path: str) -> None:
+    with open(from_path, "rb") as f:
+        jaeger_traces = orjson.loads(f.read())
+    translate_jaeger_to_gent_from_list(jaeger_traces, to_path)
 
 
 def translate_jaeger_to_gent_from_list(jaeger_traces: List[dict], filepath: Optional[str] = None) -> None:
-        with open(filepath, "w") as f:
+        with open(filepath, "wb") as f:
             for jaeger_trace in jaeger_traces:
                 gent_trace = _handle_jaeger_trace(jaeger_trace)
                 if gent_trace:
-                    f.write(json.dumps(gent_trace) + ",\n")
+                    f.write(orjson.dumps(gent_trace, option=orjson.OPT_NON_STR_KEYS))
+                    f.write(b",\n")
 
 
 if __name__ == '__main__':
@@ -1,5 +1,4 @@
 import argparse
-import json
 import math
 import os
 import random
@@ -12,9 +11,11 @@ from time import sleep
 from typing import Set, NamedTuple, List, Literal
 
 import docker
+import numpy as np
+import orjson
 from docker.models.containers import Container
 
-from jaeger_to_gent import download_traces_from_jaeger_for_all_services
+from jaeger_to_gent import download_traces_from_jaeger_for_all_services, list_trace_files
 
 FUZZLER_COMPILE_COMMAND = "/RESTler/restler/Restler compile --api_spec ./swagger.json"
 EXEC_FUZZ_LEAN_COMMAND = "/RESTler/restler/Restler fuzz-lean --grammar_file ./Compile/grammar.py --dictionary_file ./Compile/dict.json --settings ./Compile/engine_settings.json --no_ssl"
@@ -87,10 +88,13 @@ def setup_test(app: AppName, deathstar_dir: str):
 
 def print_result(app: str):
     results_dir = f"{BENCHMARK_DIR}/{app}/FuzzLean/RestlerResults/"
-    for experiment in os.listdir(results_dir):
-        print(f"Experiment {experiment}")
-        with open(f"{results_dir}/{experiment}/logs/main.txt") as f:
-            print(f.read())
+    with os.scandir(results_dir) as experiments:
+        for experiment in experiments:
+            if not experiment.is_dir():
+                continue
+            print(f"Experiment {experiment.name}")
+            with open(f"{experiment.path}/logs/main.txt") as f:
+                print(f.read())
 
 
 def wait_for_container(container: Container, timeout: int = 60) -> bool:
@@ -156,13 +160,17 @@ def get_merged_traces_base_path(working_directory: Path) -> Path:
     return working_directory / "merged_traces"
 
 
+def load_traces(directory: Path) -> List[dict]:
+    traces = []
+    for f in list_trace_files(directory):
+        traces.extend(orjson.loads(Path(f).read_bytes()))
+    return traces
+
+
 def run_test(app: AppName, incidents: List[Incident], deathstar_dir: str, target_count: int, working_directory: Path):
     for incident in incidents:
         target_dir = get_incident_traces_path(app, incident, working_directory)
-        incident_traces = []
-        if os.path.exists(target_dir):
-            for f in os.listdir(target_dir):
-                incident_traces.extend(json.load(open(os.path.join(target_dir, f))))
+        incident_traces = load_traces(target_dir) if os.path.exists(target_dir) else []
         if len(incident_traces) > target_count:
             print(f"Skipping incident {incident.incident_name} as it already has enough traces")
             continue
@@ -196,43 +204,40 @@ def create_baseline(app: AppName, deathstar_dir: str, target_count: int, working
 
 
 def merge_with_exp(benign_traces: List[dict], incident_traces: List[dict], exp_lambda: float, target_count: int) -> List[dict]:
-    merged_traces = []
-    time_until_next_incident = random.expovariate(exp_lambda)
-
-    for trace in benign_traces:
-        if time_until_next_incident <= 0:
-            if not incident_traces:
-                if len(merged_traces) > target_count:
-                    break
-                raise Exception(f"Ran out of incidents after {len(merged_traces)} / {target_count}. Shouldn't happen. "
-                                f"Create more incidents.")
-            merged_traces.append(incident_traces.pop())
-            time_until_next_incident = random.expovariate(exp_lambda)
-        else:
-            merged_traces.append(trace)
-            time_until_next_incident -= 1
-
+    # An incident replaces the benign trace at its position, and is followed by an exponentially distributed
+    # number of benign traces. The extra draw is where the next incident would go once all of them are used.
+    gaps = np.ceil(np.random.default_rng().exponential(1 / exp_lambda, size=len(incident_traces) + 1)).astype(np.int64)
+    positions = np.cumsum(gaps + 1) - 1
+    positions = positions[positions < len(benign_traces)]
+    if len(positions) > len(incident_traces):
+        out_of_incidents = int(positions[-1])
+        if out_of_incidents <= target_count:
+            raise Exception(f"Ran out of incidents after {out_of_incidents} / {target_count}. Shouldn't happen. "
+                            f"Create more incidents.")
+        benign_traces, positions = benign_traces[:out_of_incidents], positions[:-1]
+
+    merged_traces = list(benign_traces)
+    for position, incident_trace in zip(positions, reversed(incident_traces)):
+        merged_traces[position] = incident_trace
     return merged_traces
 
 
 def prepare_merged_traces(app: AppName, incident: Incident, exp_lambda: float, target_count: int, working_directory: Path):
-    incident_traces = []
     incident_dir = get_incident_traces_path(app, incident, working_directory)
     if not os.path.exists(incident_dir):
         print(f"Skipping incident {incident.incident_name} as it does not have traces")
         return
     print(f"Preparing merged traces for incident {incident.incident_name} with lambda {exp_lambda}")
-    for f in os.listdir(incident_dir):
-        incident_traces.extend(json.load(open(os.path.join(incident_dir, f))))
+    incident_traces = load_traces(incident_dir)
 
     benign_dir = get_baseline_traces_path(app, working_directory)
-    benign_traces = sum((json.load(open(os.path.join(benign_dir, f))) for f in os.listdir(benign_dir)), [])
+    benign_traces = load_traces(benign_dir)
 
     merged_traces = merge_with_exp(benign_traces, incident_traces, exp_lambda, target_count=target_count)
 
     target_dir = get_merged_traces_base_path(working_directory) / f"{app.value}_{incident.incident_name}_{exp_lambda}"
     os.makedirs(target_dir, exist_ok=True)
-    json.dump(merged_traces, open(f"{target_dir}/txs.json", "w"), indent=4)
+    (target_dir / "txs.json").write_bytes(orjson.dumps(merged_traces, option=orjson.OPT_INDENT_2))
 
 
 def main():
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules import each other as top-level modules (e.g. `from jaeger_to_gent import ...`)
+sys.path.insert(0, str(Path(__file__).parent.parent / "src" / "pandora_trace"))
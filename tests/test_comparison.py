@@ -0,0 +1,166 @@
+import math
+import numbers
+import random
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from comparison import TraceComparator, _prepare_query
+
+SERVICES = ["frontend", "auth", "cart", "orders"]
+PARAMETERS = {
+    "entry_point": SERVICES,
+    "service_name": SERVICES,
+    "service_name2": SERVICES[:2],
+    "attr_name": ["status", "http_method", "parentId"],
+    "int_attr_name": ["duration", "startTime"],
+}
+
+
+def _create_table(connection: sqlite3.Connection, table: str, time_type: str, null_ratio: float, seed: int) -> None:
+    rnd = random.Random(seed)
+
+    def maybe_null(value):
+        return None if rnd.random() < null_ratio else value
+
+    connection.execute(f"""
+        CREATE TABLE {table} (
+            traceId TEXT, spanId TEXT, parentId TEXT, serviceName TEXT,
+            startTime {time_type}, endTime {time_type}, status INTEGER, duration INTEGER, http_method TEXT
+        )
+    """)
+    rows = []
+    for trace in range(200):
+        span_ids = []
+        base = rnd.randint(0, 20_000)
+        for _ in range(rnd.randint(1, 6)):
+            span_id = str(len(rows))
+            start = base + rnd.randint(0, 100) + (rnd.choice([0, 0.25, 0.5]) if time_type == "REAL" else 0)
+            rows.append((
+                maybe_null(f"t{trace}"),
+                maybe_null(span_id),
+                maybe_null(rnd.choice(span_ids)) if span_ids else None,
+                maybe_null(rnd.choice(SERVICES)),
+                maybe_null(start),
+                maybe_null(start + rnd.choice([0, 1, 7, 40, 100])),
+                maybe_null(int(rnd.random() < 0.2)),
+                maybe_null(rnd.randint(-5, 50)),
+                maybe_null(rnd.choice(["GET", "POST"])),
+            ))
+            span_ids.append(span_id)
+    connection.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * 9)})", rows)
+
+
+def _normalized(result: pd.DataFrame) -> list:
+    def value(v):
+        if v is None or v is pd.NA or (isinstance(v, numbers.Real) and math.isnan(v)):
+            return None
+        return float(v) if isinstance(v, numbers.Real) else v
+
+    def sort_key(row):
+        # NULLs, strings and numbers don't compare with each other, so sort by kind first
+        return tuple((x is None, type(x).__name__, 0 if x is None else x) for x in row)
+
+    return sorted(((value(f), value(c)) for f, c in zip(result["f"], result["c"])), key=sort_key)
+
+
+@pytest.mark.parametrize("time_type", ["INTEGER", "REAL"])
+@pytest.mark.parametrize("null_ratio", [0, 0.1])
+def test_default_handlers_match_their_sql(time_type, null_ratio):
+    connection = sqlite3.connect(":memory:")
+    _create_table(connection, "traces", time_type, null_ratio, seed=int(null_ratio * 10))
+    comparator = TraceComparator(connection)
+    for query_template in comparator.default_queries:
+        for params in comparator._iterate_parameters(query_template.query, PARAMETERS):
+            sql_result = comparator._execute_query(_prepare_query(query_template.query, "traces"), params)
+            handler_result = query_template.handler(comparator._load_table("traces"), params)
+            assert _normalized(handler_result) == _normalized(sql_result), (query_template.name, params)
+
+
+def test_integer_columns_with_nulls_keep_integer_division():
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE traces (traceId TEXT, spanId TEXT, parentId TEXT, serviceName TEXT, "
+                       "startTime INTEGER, endTime INTEGER, status INTEGER)")
+    connection.executemany("INSERT INTO traces VALUES (?, ?, ?, ?, ?, ?, ?)", [
+        ("a", "1", None, "s", 7201, 7300, 0),
+        ("a", "2", "1", "s", 7202, 7290, 1),
+        ("b", "3", None, "s", None, 10, 0),
+        ("c", "4", None, "s", 10, 21, 0),
+    ])
+    comparator = TraceComparator(connection)
+    red_rate = next(q for q in comparator.default_queries if q.name == "red_rate")
+    result = red_rate.handler(comparator._load_table("traces"), {"service_name": "s"})
+    assert _normalized(result) == [(0.0, 1.0), (2.0, 2.0), (None, 1.0)]
+
+
+def test_null_trace_ids_are_not_joined():
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE traces (traceId TEXT, spanId TEXT, parentId TEXT, serviceName TEXT, "
+                       "startTime INTEGER, endTime INTEGER, status INTEGER)")
+    connection.executemany("INSERT INTO traces VALUES (?, ?, ?, ?, ?, ?, ?)", [
+        (None, "1", None, "fe", 0, 10, 0),
+        (None, "2", "1", "db", 2, 5, 0),
+        ("x", "3", None, "fe", 0, 10, 0),
+        ("x", "4", "3", "db", 0, 10, 0),
+    ])
+    comparator = TraceComparator(connection)
+    bottlenecks = next(q for q in comparator.default_queries if q.name == "bottlenecks")
+    result = bottlenecks.handler(comparator._load_table("traces"), {"entry_point": "fe", "service_name": "db"})
+    assert _normalized(result) == [(1.0, 1.0)]
+
+
+def test_label_distance_does_not_depend_on_label_names():
+    def result(weights):
+        return pd.DataFrame({"f": list(weights), "c": list(weights.values())})
+
+    distance = TraceComparator._calculate_wasserstein
+    assert distance(result({"a": 1, "y": 1}), result({"b": 1, "z": 1})) == 1.0
+    assert distance(result({"a": 1, "b": 1}), result({"y": 1, "z": 1})) == 1.0
+    assert distance(result({"a": 1, "b": 3}), result({"a": 3, "b": 1})) == 0.5
+
+
+def test_null_features_are_ignored():
+    syn = pd.DataFrame({"f": ["GET", None], "c": [1, 5]})
+    real = pd.DataFrame({"f": [1.0, float("nan")], "c": [1, 5]})
+    assert TraceComparator._calculate_wasserstein(syn, pd.DataFrame({"f": ["GET"], "c": [2]})) == 0.0
+    assert TraceComparator._calculate_wasserstein(real, pd.DataFrame({"f": [1.0], "c": [2]})) == 0.0
+
+
+def test_negative_weights_are_excluded():
+    syn = pd.DataFrame({"f": [1, 2], "c": [-3, 4]})
+    real = pd.DataFrame({"f": [1, 2], "c": [3, 4]})
+    with pytest.warns(UserWarning, match="negative weights"):
+        assert TraceComparator._calculate_wasserstein(syn, real) is None
+
+
+def test_indexes_are_created_independently():
+    connection = sqlite3.connect(":memory:")
+    # No parentId column, so only that index fails
+    connection.execute("CREATE TABLE traces (traceId TEXT, serviceName TEXT, startTime INTEGER)")
+    with pytest.warns(UserWarning, match="parentId"):
+        TraceComparator(connection)._create_indexes("traces")
+    indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert indexes == {"idx_traces_svc_tid", "idx_traces_svc_start"}
+
+
+def test_read_only_database_is_not_indexed(tmp_path):
+    path = tmp_path / "traces.db"
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE traces (traceId TEXT, parentId TEXT, serviceName TEXT, startTime INTEGER)")
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    with pytest.warns(UserWarning, match="read-only") as record:
+        TraceComparator(connection)._create_indexes("traces")
+    assert len(record) == 1
+
+
+def test_clear_cache_reloads_modified_tables():
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE traces (traceId TEXT, serviceName TEXT)")
+    connection.execute("INSERT INTO traces VALUES ('a', 's')")
+    comparator = TraceComparator(connection)
+    assert len(comparator._load_table("traces")) == 1
+    connection.execute("INSERT INTO traces VALUES ('b', 's')")
+    assert len(comparator._load_table("traces")) == 1
+    comparator.clear_cache()
+    assert len(comparator._load_table("traces")) == 2
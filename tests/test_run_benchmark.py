@@ -0,0 +1,73 @@
+import random
+
+import numpy as np
+import pytest
+
+import run_benchmark
+from run_benchmark import merge_with_exp
+
+
+class _FixedGaps:
+    """Stands in for `np.random.default_rng()`, returning the given exponential draws in order."""
+
+    def __init__(self, draws):
+        self.draws = draws
+
+    def exponential(self, scale, size):
+        assert size <= len(self.draws)
+        return np.array(self.draws[:size])
+
+
+def _reference_merge_with_exp(benign_traces, incident_traces, draws, target_count):
+    """The original loop, with `random.expovariate` replaced by the same draws."""
+    draws = iter(draws)
+    incident_traces = list(incident_traces)
+    merged_traces = []
+    time_until_next_incident = next(draws)
+
+    for trace in benign_traces:
+        if time_until_next_incident <= 0:
+            if not incident_traces:
+                if len(merged_traces) > target_count:
+                    break
+                raise Exception(f"Ran out of incidents after {len(merged_traces)} / {target_count}. Shouldn't happen. "
+                                f"Create more incidents.")
+            merged_traces.append(incident_traces.pop())
+            time_until_next_incident = next(draws)
+        else:
+            merged_traces.append(trace)
+            time_until_next_incident -= 1
+
+    return merged_traces
+
+
+def _merge_or_error(merge):
+    try:
+        return merge()
+    except Exception as e:
+        return str(e)
+
+
+def test_merge_with_exp_matches_the_original_loop(monkeypatch):
+    rnd = random.Random(0)
+    for _ in range(2000):
+        benign_traces = [{"benign": i} for i in range(rnd.randint(0, 30))]
+        incident_traces = [{"incident": i} for i in range(rnd.randint(0, 6))]
+        draws = [rnd.choice([0.0, 1.0, rnd.uniform(0, 8)]) for _ in range(len(incident_traces) + 1)]
+        target_count = rnd.randint(0, 30)
+
+        monkeypatch.setattr(run_benchmark.np.random, "default_rng", lambda: _FixedGaps(draws))
+        expected = _merge_or_error(lambda: _reference_merge_with_exp(benign_traces, incident_traces, draws, target_count))
+        actual = _merge_or_error(lambda: merge_with_exp(benign_traces, incident_traces, 0.5, target_count))
+        assert actual == expected, (len(benign_traces), len(incident_traces), draws, target_count)
+
+
+@pytest.mark.parametrize("target_count, expected", [
+    (2, [{"benign": 0}, {"incident": 1}, {"benign": 2}, {"incident": 0}]),
+    (5, "Ran out of incidents after 4 / 5. Shouldn't happen. Create more incidents."),
+])
+def test_merge_with_exp_out_of_incidents(monkeypatch, target_count, expected):
+    benign_traces = [{"benign": i} for i in range(10)]
+    incident_traces = [{"incident": 0}, {"incident": 1}]
+    monkeypatch.setattr(run_benchmark.np.random, "default_rng", lambda: _FixedGaps([1.0, 1.0, 0.0]))
+    assert _merge_or_error(lambda: merge_with_exp(benign_traces, incident_traces, 0.5, target_count)) == expected